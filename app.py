@@ -1,12 +1,13 @@
 
 import streamlit as st
 import pandas as pd
-import json, os, io
+import csv, json, os, io, tempfile, threading
 from datetime import datetime
 from pytz import timezone
-import matplotlib.pyplot as plt
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB = os.path.join(BASE_DIR, "db")
@@ -15,80 +16,195 @@ os.makedirs(DB, exist_ok=True)
 VOTES = os.path.join(DB, "votes.csv")
 TOPICS = os.path.join(DB, "topics.csv")
 ADMIN = os.path.join(BASE_DIR, "admin_config.json")
+TZ = timezone("Asia/Taipei")
 
 def now():
-    return datetime.now(timezone("Asia/Taipei")).strftime("%Y-%m-%d %H:%M:%S")
+    return datetime.now(TZ).strftime("%Y-%m-%d %H:%M:%S")
+
+@st.cache_data(show_spinner=False)
+def _read_csv(path, mtime):
+    return pd.read_csv(path)
 
 def load_csv(path, cols):
-    if not os.path.exists(path):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
         return pd.DataFrame(columns=cols)
-    return pd.read_csv(path)
+    return _read_csv(path, os.path.getmtime(path))
+
+@st.cache_data(show_spinner=False)
+def _read_topics(path, mtime):
+    df = pd.read_csv(path, usecols=["議題","選項"], dtype=str)
+    return list(zip(df["議題"], df["選項"].map(json.loads)))
+
+def load_topics():
+    if not os.path.exists(TOPICS) or os.path.getsize(TOPICS) == 0:
+        return []
+    return _read_topics(TOPICS, os.path.getmtime(TOPICS))
+
+@st.cache_data(show_spinner=False)
+def _read_votes(mtime):
+    return pd.read_csv(VOTES, usecols=["戶號","議題","選項","時間"], dtype=str)
+
+def load_votes():
+    if not os.path.exists(VOTES) or os.path.getsize(VOTES) == 0:
+        return pd.DataFrame(columns=["戶號","議題","選項","時間"])
+    return _read_votes(os.path.getmtime(VOTES))
+
+@st.cache_resource(show_spinner=False)
+def _voted_index():
+    return {"keys": set(), "offset": 0, "ino": None, "lock": threading.Lock()}
+
+def _sync_voted():
+    idx = _voted_index()
+    with idx["lock"]:
+        try:
+            stat = os.stat(VOTES)
+        except FileNotFoundError:
+            stat = None
+        if stat is None or stat.st_ino != idx["ino"] or stat.st_size < idx["offset"]:
+            idx.update(keys=set(), offset=0, ino=stat and stat.st_ino)
+        if stat is not None and stat.st_size > idx["offset"]:
+            with open(VOTES, "rb") as f:
+                f.seek(idx["offset"])
+                data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end:
+                text = data[:end].decode("utf-8-sig" if idx["offset"] == 0 else "utf-8")
+                rows = csv.reader(io.StringIO(text))
+                if idx["offset"] == 0:
+                    next(rows, None)
+                idx["keys"].update((r[0], r[1]) for r in rows if len(r) >= 2)
+                idx["offset"] += end
+        return idx["keys"]
+
+def has_voted(house, topic):
+    return (house, topic) in _sync_voted()
 
-def save_vote(house, topic, choice):
-    df = load_csv(VOTES, ["戶號","議題","選項","時間"])
-    if not df[(df["戶號"]==house)&(df["議題"]==topic)].empty:
-        return False
-    df.loc[len(df)] = [house, topic, choice, now()]
-    df.to_csv(VOTES, index=False, encoding="utf-8-sig")
-    return True
+@st.cache_resource(show_spinner=False)
+def _vote_lock():
+    return threading.Lock()
+
+def save_votes(house, choices):
+    with _vote_lock(), open(VOTES + ".lock", "w") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        voted = _sync_voted()
+        ts = now()
+        rows = [[house, topic, choice, ts] for topic, choice in choices.items()
+                if (house, topic) not in voted]
+        if not rows:
+            return 0
+        new_file = not os.path.exists(VOTES) or os.path.getsize(VOTES) == 0
+        with open(VOTES, "a", encoding="utf-8-sig", newline="") as f:
+            w = csv.writer(f, lineterminator="\n")
+            if new_file:
+                w.writerow(["戶號","議題","選項","時間"])
+            w.writerows(rows)
+        _read_votes.clear()
+    return len(rows)
+
+def save_topics(df):
+    try:
+        mode = os.stat(TOPICS).st_mode & 0o777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    fd, tmp = tempfile.mkstemp(dir=DB, suffix=".csv")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8-sig", newline="") as f:
+            df.to_csv(f, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp, mode)
+        os.replace(tmp, TOPICS)
+    except Exception:
+        os.remove(tmp)
+        raise
+    _read_csv.clear()
+    _read_topics.clear()
 
 def voting_page(house):
     st.title("住戶投票")
-    topics = load_csv(TOPICS, ["議題","選項"])
-    votes = load_csv(VOTES, ["戶號","議題","選項","時間"])
-    for _, r in topics.iterrows():
-        topic = r["議題"]
-        options = json.loads(r["選項"])
-        st.subheader(topic)
-        if not votes[(votes["戶號"]==house)&(votes["議題"]==topic)].empty:
-            st.success("已投票")
-            continue
-        choice = st.multiselect("選擇（可複選）", options, key=topic)
-        if st.button("送出", key=topic+"_btn"):
-            if choice:
-                save_vote(house, topic, ",".join(choice))
-                st.rerun()
+    topics = load_topics()
+    pending = {t for t, _ in topics if not has_voted(house, t)}
+    choices = {}
+    with st.form("vote_form") if pending else st.container():
+        for topic, options in topics:
+            st.subheader(topic)
+            if topic not in pending:
+                st.success("已投票")
+                continue
+            choices[topic] = st.multiselect("選擇（可複選）", options, key=topic)
+        submitted = bool(pending) and st.form_submit_button("送出")
+    if submitted:
+        picked = {t: ",".join(c) for t, c in choices.items() if c}
+        if picked:
+            save_votes(house, picked)
+            st.rerun()
 
 def export_excel():
-    df = load_csv(VOTES, ["戶號","議題","選項","時間"])
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "投票結果"
-    headers = ["戶號","議題","選項","時間"]
-    ws.append(headers)
-    for c in ws[1]:
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font, Alignment
+    df = load_votes()
+    ids = df["戶號"]
+    if ids.notna().all() and ids.str.fullmatch(r"\d+").all():
+        df = df.assign(戶號=ids.astype("int64"))
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("投票結果")
+    headers = []
+    for h in ["戶號","議題","選項","時間"]:
+        c = WriteOnlyCell(ws, value=h)
         c.font = Font(bold=True)
         c.alignment = Alignment(horizontal="center")
-    for _, r in df.iterrows():
+        headers.append(c)
+    ws.append(headers)
+    for r in df.itertuples(index=False):
         ws.append(list(r))
     buf = io.BytesIO()
     wb.save(buf)
     buf.seek(0)
     return buf
 
+@st.fragment
+def topics_tab():
+    st.info("議題 CSV 欄位：議題 / 選項(JSON陣列)")
+    df = load_csv(TOPICS, ["議題","選項"])
+    new = st.data_editor(df, num_rows="dynamic")
+    if st.button("儲存"):
+        save_topics(new)
+        st.success("已儲存")
+
+@st.fragment
+def stats_tab():
+    import altair as alt
+    df = load_votes()
+    if df.empty:
+        st.info("尚無資料")
+        return
+    agg = (df.assign(選項=df["選項"].str.split(","))
+             .explode("選項")
+             .groupby(["議題","選項"]).size())
+    for topic in df["議題"].unique():
+        st.subheader(topic)
+        counts = agg.loc[topic].rename_axis("選項").reset_index(name="票數")
+        chart = alt.Chart(counts).mark_bar().encode(
+            x=alt.X("選項", sort="-y"), y="票數")
+        st.altair_chart(chart, use_container_width=True)
+
+@st.fragment
+def export_tab():
+    st.download_button("下載 Excel", export_excel(), "committee_report.xlsx")
+
 def admin_page():
     st.title("管理後台")
     tabs = st.tabs(["議題設定","統計","匯出"])
     with tabs[0]:
-        st.info("議題 CSV 欄位：議題 / 選項(JSON陣列)")
-        df = load_csv(TOPICS, ["議題","選項"])
-        new = st.data_editor(df, num_rows="dynamic")
-        if st.button("儲存"):
-            new.to_csv(TOPICS, index=False, encoding="utf-8-sig")
-            st.success("已儲存")
+        topics_tab()
     with tabs[1]:
-        df = load_csv(VOTES, ["戶號","議題","選項","時間"])
-        if df.empty:
-            st.info("尚無資料")
-        else:
-            for topic in df["議題"].unique():
-                st.subheader(topic)
-                counts = df[df["議題"]==topic]["選項"].str.split(",").explode().value_counts()
-                fig, ax = plt.subplots()
-                counts.plot(kind="bar", ax=ax)
-                st.pyplot(fig)
+        stats_tab()
     with tabs[2]:
-        st.download_button("下載 Excel", export_excel(), "committee_report.xlsx")
+        export_tab()
 
 def main():
     st.set_page_config(layout="wide")